@@ -1,7 +1,16 @@
-import json
-import time
-from random import randint
+import logging
+from functools import lru_cache
+from types import SimpleNamespace
 
+try:
+    from orjson import dumps as json_dumps
+except ImportError:
+    import json
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
+from eventlet import tpool
 from graph import Graph
 from ryu.app.wsgi import ControllerBase, Response, WSGIApplication, route
 from ryu.base import app_manager
@@ -13,11 +22,20 @@ from ryu.controller.handler import (
     set_ev_cls,
 )
 from ryu.lib import dpid as dpid_lib
-from ryu.lib.packet import ethernet, packet
+from ryu.lib import hub
+from ryu.lib.packet import ether_types
 from ryu.ofproto import ofproto_v1_3
 from ryu.topology import event
 from ryu.topology.api import get_host, get_link, get_switch
 
+_str_to_dpid = lru_cache(maxsize=1024)(dpid_lib.str_to_dpid)
+
+
+def _serialize(items):
+    # to_dict() reads live objects owned by the switches app, so it runs on
+    # the hub; only the encoding of the plain result goes to a worker thread.
+    return tpool.execute(json_dumps, [item.to_dict() for item in items])
+
 
 class TopologyController(ControllerBase):
     def __init__(self, req, link, data, **config):
@@ -63,28 +81,43 @@ class TopologyController(ControllerBase):
     def get_hosts(self, req, **kwargs):
         return self._hosts(req, **kwargs)
 
+    def _cached_body(self, kind, dpid, fetch):
+        # Bodies are cached per topology version, which the app bumps on
+        # every topology event. Empty results are not cached so unknown
+        # dpids do not pile up entries.
+        app = self.topology_api_app
+        key = (kind, dpid, app._topo_version)
+        body = app._json_cache.get(key)
+        if body is None:
+            items = fetch(app, dpid)
+            body = _serialize(items)
+            # fetch and serialize yield, so a topology event may have cleared
+            # the cache in between; don't store a body for a stale version
+            if items and app._topo_version == key[2]:
+                app._json_cache[key] = body
+        return body
+
     def _switches(self, req, **kwargs):
         dpid = None
         if "dpid" in kwargs:
-            dpid = dpid_lib.str_to_dpid(kwargs["dpid"])
-        switches = get_switch(self.topology_api_app, dpid)
-        body = json.dumps([switch.to_dict() for switch in switches])
+            dpid = _str_to_dpid(kwargs["dpid"])
+        body = self._cached_body("sw", dpid, get_switch)
         return Response(content_type="application/json", body=body)
 
     def _links(self, req, **kwargs):
         dpid = None
         if "dpid" in kwargs:
-            dpid = dpid_lib.str_to_dpid(kwargs["dpid"])
-        links = get_link(self.topology_api_app, dpid)
-        body = json.dumps([link.to_dict() for link in links])
+            dpid = _str_to_dpid(kwargs["dpid"])
+        body = self._cached_body("link", dpid, get_link)
         return Response(content_type="application/json", body=body)
 
     def _hosts(self, req, **kwargs):
         dpid = None
         if "dpid" in kwargs:
-            dpid = dpid_lib.str_to_dpid(kwargs["dpid"])
-        hosts = get_host(self.topology_api_app, dpid)
-        body = json.dumps([host.to_dict() for host in hosts])
+            dpid = _str_to_dpid(kwargs["dpid"])
+        # Hosts are not cached: the switches app learns their IP addresses
+        # after EventHostAdd without firing another event.
+        body = _serialize(get_host(self.topology_api_app, dpid))
         return Response(content_type="application/json", body=body)
 
 
@@ -94,7 +127,16 @@ class SimpleSwitch13(app_manager.RyuApp):
 
     def __init__(self, *args, **kwargs):
         super(SimpleSwitch13, self).__init__(*args, **kwargs)
+        # (dpid, raw 6-byte mac) -> port
         self.mac_to_port = {}
+        self._dp_cache = {}
+        self._cookie = 0
+        self._action_cache = {}
+        self._topo_event = hub.Event()
+        self._topo_thread = None
+        self._graph_key = None
+        self._json_cache = {}
+        self._topo_version = 0
         wsgi = kwargs["wsgi"]
         wsgi.register(TopologyController, {"topology_api_app": self})
 
@@ -103,34 +145,70 @@ class SimpleSwitch13(app_manager.RyuApp):
         datapath = ev.msg.datapath
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
+        self._dp_cache[datapath.id] = self._dp_constants(datapath)
         match = parser.OFPMatch()
         actions = [
             parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, ofproto.OFPCML_NO_BUFFER)
         ]
         self.add_flow(datapath, 0, match, actions)
 
-    def add_flow(self, datapath, priority, match, actions, buffer_id=None):
+    def _dp_constants(self, datapath):
+        # per-datapath constants used by the packet-in and add_flow paths
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
+        return SimpleNamespace(
+            flood=ofproto.OFPP_FLOOD,
+            no_buf=ofproto.OFP_NO_BUFFER,
+            apply_actions=ofproto.OFPIT_APPLY_ACTIONS,
+            ActOut=parser.OFPActionOutput,
+            Match=parser.OFPMatch,
+            FlowMod=parser.OFPFlowMod,
+            Inst=parser.OFPInstructionActions,
+            PacketOut=parser.OFPPacketOut,
+        )
 
-        inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, actions)]
-        if buffer_id:
-            mod = parser.OFPFlowMod(
-                datapath=datapath,
-                buffer_id=buffer_id,
-                priority=priority,
-                match=match,
-                instructions=inst,
-            )
+    def _next_cookie(self):
+        self._cookie = (self._cookie + 1) & 0xFF
+        return self._cookie
+
+    def _output_actions(self, dpid, port):
+        # Shared between flows, so callers must not modify the returned list.
+        key = (dpid, port)
+        actions = self._action_cache.get(key)
+        if actions is None:
+            actions = [self._dp_cache[dpid].ActOut(port)]
+            self._action_cache[key] = actions
+        return actions
+
+    def add_flow(self, datapath, priority, match, actions, buffer_id=None):
+        datapath.send_msg(self._flow_mod(datapath, priority, match, actions, buffer_id))
+
+    def _flow_mod(self, datapath, priority, match, actions, buffer_id=None):
+        c = self._dp_cache[datapath.id]
+
+        kw = dict(
+            datapath=datapath,
+            priority=priority,
+            match=match,
+            instructions=[c.Inst(c.apply_actions, actions)],
+        )
+        # buffer_id 0 is a valid buffer; only None means there is none
+        if buffer_id is not None:
+            kw["buffer_id"] = buffer_id
         else:
-            mod = parser.OFPFlowMod(
-                datapath=datapath,
-                priority=priority,
-                match=match,
-                instructions=inst,
-                cookie=randint(0, 255),
+            kw["cookie"] = self._next_cookie()
+        return c.FlowMod(**kw)
+
+    def _send_msgs(self, datapath, msgs):
+        # Serialize the batch up front and hand it to the datapath's send
+        # queue as a single write instead of one send_msg() per message.
+        for msg in msgs:
+            datapath.set_xid(msg)
+            msg.serialize()
+        if not datapath.send(b"".join(msg.buf for msg in msgs)):
+            self.logger.warning(
+                "Datapath %s is closing, dropped %d flow mods", datapath.id, len(msgs)
             )
-        datapath.send_msg(mod)
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, ev):
@@ -142,44 +220,42 @@ class SimpleSwitch13(app_manager.RyuApp):
             )
         msg = ev.msg
         datapath = msg.datapath
-        ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser
+        c = self._dp_cache[datapath.id]
         in_port = msg.match["in_port"]
 
-        pkt = packet.Packet(msg.data)
-        eth = pkt.get_protocols(ethernet.ethernet)[0]
-
-        dst = eth.dst
-        src = eth.src
+        # Only the ethernet addresses are needed, so read them straight out
+        # of the frame instead of parsing the whole packet.
+        dst = bytes(msg.data[0:6])
+        src = bytes(msg.data[6:12])
+        if int.from_bytes(msg.data[12:14], "big") == ether_types.ETH_TYPE_LLDP:
+            # ignore lldp packet
+            return
 
         dpid = datapath.id
-        self.mac_to_port.setdefault(dpid, {})
         # self.logger.info("\tpacket in %s %s %s %s", dpid, src, dst, in_port)
         # learn a mac address to avoid FLOOD next time.
-        self.mac_to_port[dpid][src] = in_port
+        self.mac_to_port[(dpid, src)] = in_port
 
-        if dst in self.mac_to_port[dpid]:
-            out_port = self.mac_to_port[dpid][dst]
-        else:
-            out_port = ofproto.OFPP_FLOOD
+        out_port = self.mac_to_port.get((dpid, dst), c.flood)
 
-        actions = [parser.OFPActionOutput(out_port)]
+        actions = self._output_actions(dpid, out_port)
 
         # install a flow to avoid packet_in next time
-        if out_port != ofproto.OFPP_FLOOD:
-            match = parser.OFPMatch(in_port=in_port, eth_dst=dst)
+        if out_port != c.flood:
+            eth_dst = dst.hex(":")
+            match = c.Match(in_port=in_port, eth_dst=eth_dst)
             # verify if we have a valid buffer_id, if yes avoid to send both
             # flow_mod & packet_out
-            if msg.buffer_id != ofproto.OFP_NO_BUFFER:
+            if msg.buffer_id != c.no_buf:
                 self.add_flow(datapath, 1, match, actions, msg.buffer_id)
                 return
             else:
                 self.add_flow(datapath, 1, match, actions)
         data = None
-        if msg.buffer_id == ofproto.OFP_NO_BUFFER:
+        if msg.buffer_id == c.no_buf:
             data = msg.data
 
-        out = parser.OFPPacketOut(
+        out = c.PacketOut(
             datapath=datapath,
             buffer_id=msg.buffer_id,
             in_port=in_port,
@@ -188,17 +264,57 @@ class SimpleSwitch13(app_manager.RyuApp):
         )
         datapath.send_msg(out)
 
-    def get_topology(self):
-        self.switches = get_switch(self)
-        self.links = get_link(self)
-        self.hosts = get_host(self)
+    def _links_complete(self):
+        # LLDP discovers each direction of a link separately, so wait until
+        # every switch has a link and every link has its reverse.
+        ends = {(l.src.dpid, l.dst.dpid) for l in self.links}
+        if len(self.switches) > 1 and {src for src, _ in ends} != {
+            s.dp.id for s in self.switches
+        }:
+            return False
+        return all((dst, src) in ends for src, dst in ends)
 
-        while len(self.switches) != len(self.hosts):
-            time.sleep(0.05)
-            print("\rLoading....")
+    def get_topology(self):
+        # Re-fetch when a topology event arrives or every 0.5s; return once
+        # every switch has its host, the links are complete and two samples
+        # taken across a quiet interval match.
+        last = None
+        quiet = False
+        while True:
+            self._topo_event.clear()
             self.switches = get_switch(self)
             self.links = get_link(self)
             self.hosts = get_host(self)
+            sample = (len(self.switches), len(self.hosts), len(self.links))
+            if (
+                quiet
+                and sample == last
+                and sample[0] == sample[1]
+                and self._links_complete()
+            ):
+                return
+            last = sample
+            quiet = not self._topo_event.wait(timeout=0.5)
+
+    def _topology_changed(self):
+        self._topo_version += 1
+        self._json_cache.clear()
+        self._topo_event.set()
+
+    """
+    Topology events invalidate the REST cache and wake up get_topology().
+    """
+
+    @set_ev_cls(event.EventHostAdd)
+    @set_ev_cls(event.EventHostDelete)
+    @set_ev_cls(event.EventHostMove)
+    @set_ev_cls(event.EventLinkAdd)
+    @set_ev_cls(event.EventLinkDelete)
+    @set_ev_cls(event.EventPortAdd)
+    @set_ev_cls(event.EventPortDelete)
+    @set_ev_cls(event.EventPortModify)
+    def handler_topology_change(self, ev):
+        self._topology_changed()
 
     """
     The event EventSwitchEnter will trigger the activation of get_topology_data().
@@ -206,60 +322,95 @@ class SimpleSwitch13(app_manager.RyuApp):
 
     @set_ev_cls(event.EventSwitchEnter)
     def handler_switch_event(self, ev):
-        print("New Switch", end="")
-        self.get_topology()
-
-        print("-------------------------------------------------")
-        print("\nAll Links:")
-        for l in self.links:
-            print(l)
-
-        print("\nAll Switches:")
-        for s in self.switches:
-            print(s)
+        self.logger.debug("New Switch")
+        self._topology_changed()
+        # Waiting for the topology inside the handler would block the event
+        # loop that delivers EventHostAdd/EventLinkAdd, so run it in its own
+        # thread; switches entering meanwhile are picked up by that thread.
+        if self._topo_thread is None:
+            self._topo_thread = hub.spawn(self._install_path_loop)
+
+    def _topology_key(self):
+        return (
+            frozenset(s.dp.id for s in self.switches),
+            frozenset((h.mac, h.port.dpid, h.port.port_no) for h in self.hosts),
+            frozenset(
+                (l.src.dpid, l.src.port_no, l.dst.dpid, l.dst.port_no)
+                for l in self.links
+            ),
+        )
 
-        print("\nAll Hosts:")
-        for h in self.hosts:
-            print(h)
+    def _install_path_loop(self):
+        # Rebuild the graph only when the switches, hosts or links it is built
+        # from changed, and check again afterwards in case the topology moved
+        # while the previous graph was being built.
+        try:
+            while True:
+                self.get_topology()
+                key = self._topology_key()
+                if key == self._graph_key and not self._topo_event.is_set():
+                    break
+                if key != self._graph_key:
+                    self._graph_key = key
+                    self._install_path()
+        finally:
+            self._topo_thread = None
+
+    def _install_path(self):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(
+                "\nAll Links:\n%s\n\nAll Switches:\n%s\n\nAll Hosts:\n%s",
+                "\n".join(map(str, self.links)),
+                "\n".join(map(str, self.switches)),
+                "\n".join(map(str, self.hosts)),
+            )
 
         self.graph = Graph(self.switches, self.hosts, self.links)
 
-        print("\nFlows:")
-        length = len(self.graph.switch_path)
-        for switch in self.switches:
-            data = switch.to_dict()
-            src_id = int(data["dpid"]) - 1
-            if src_id not in self.graph.switch_path:
+        self.logger.debug("Flows:")
+        sp = self.graph.switch_path
+        length = len(sp)
+        edges = []
+        for i, sid in enumerate(sp):
+            in_port = 1 if i == 0 else self.graph.ports[sid][sp[i - 1]]
+            out_port = 1 if i == length - 1 else self.graph.ports[sid][sp[i + 1]]
+            edges.append((sid, in_port, out_port))
+        if any(0 in (in_port, out_port) for _, in_port, out_port in edges):
+            # graph.ports holds 0 for links LLDP has not discovered yet
+            self.logger.warning("Path crosses an undiscovered link, not installing")
+            return
+
+        by_id = {s.dp.id - 1: s for s in self.switches}
+        for src_id, in_port, out_port in edges:
+            switch = by_id.get(src_id)
+            if switch is None:
                 continue
-            else:
-                i = self.graph.switch_path.index(src_id)
 
             datapath = switch.dp
-            ofp = datapath.ofproto
-            parser = datapath.ofproto_parser
-
-
-            if i == 0:
-                in_port = 1
-            else:
-                in_port = self.graph.ports[src_id][self.graph.switch_path[i - 1]]
-
-            if i == length - 1:
-                out_port = 1
-            else:
-                out_port = self.graph.ports[src_id][self.graph.switch_path[i + 1]]
+            c = self._dp_cache.get(datapath.id)
+            if c is None:
+                # the install thread can see a switch before its
+                # EventOFPSwitchFeatures has been handled by this app
+                c = self._dp_cache[datapath.id] = self._dp_constants(datapath)
 
-            print(f"Installing flows in switch with dpid {src_id+1}:")
+            self.logger.debug(
+                "Installing flows in switch with dpid %s: "
+                "in_port %s -> %s, in_port %s -> %s",
+                src_id + 1,
+                in_port,
+                out_port,
+                out_port,
+                in_port,
+            )
 
-            print(f"Match in_port: {in_port} and Action: {out_port}")
-            match = parser.OFPMatch(in_port=in_port)
-            actions = [parser.OFPActionOutput(out_port)]
-            self.add_flow(datapath, 200, match, actions)
+            match = c.Match(in_port=in_port)
+            actions = self._output_actions(datapath.id, out_port)
+            mods = [self._flow_mod(datapath, 200, match, actions)]
+            match = c.Match(in_port=out_port)
+            actions = self._output_actions(datapath.id, in_port)
+            mods.append(self._flow_mod(datapath, 200, match, actions))
 
-            print(f"Match in_port: {out_port} and Action: {in_port}")
-            match = parser.OFPMatch(in_port=out_port)
-            actions = [parser.OFPActionOutput(in_port)]
-            self.add_flow(datapath, 200, match, actions)
+            self._send_msgs(datapath, mods)
 
     """
     This event is fired when a switch leaves the topo. i.e. fails.
@@ -269,6 +420,7 @@ class SimpleSwitch13(app_manager.RyuApp):
         event.EventSwitchLeave, [MAIN_DISPATCHER, CONFIG_DISPATCHER, DEAD_DISPATCHER]
     )
     def handler_switch_leave(self, ev):
+        self._topology_changed()
         self.logger.info("Not tracking Switches, switch leaved.")
 
 